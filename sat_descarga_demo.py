@@ -20,20 +20,67 @@ import os
 import sys
 import json
 import time
+import random
 import base64
+import hashlib
+import functools
+import logging
 import zipfile
-import io
+import threading
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime, timedelta
 from getpass import getpass
+from importlib.util import find_spec
 from typing import Optional, Dict, List, Any
 
+try:
+    from cfdiclient import (
+        Fiel,
+        Autenticacion,
+        SolicitaDescargaEmitidos,
+        SolicitaDescargaRecibidos,
+        VerificaSolicitudDescarga,
+        DescargaMasiva
+    )
+    from lxml import etree
+    _CFDI_OK = True
+except ImportError:
+    _CFDI_OK = False
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    from pybase64 import b64decode
+except ImportError:
+    from base64 import b64decode
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # ==============================================================================
 # CONFIGURACIÓN
 # ==============================================================================
 
 CONFIG_FILE = Path.home() / ".sat_descarga_config.json"
 DEFAULT_OUTPUT_DIR = Path.home() / "SAT_Descargas"
+CHUNK_B64 = 1 << 20  # Múltiplo de 4: cada bloque base64 decodifica por sí solo
+MAX_WORKERS = 4  # Peticiones simultáneas al SAT
+MAX_VERIFICACIONES = 8  # Verificaciones simultáneas (respuestas pequeñas)
+PAUSA_SOLICITUDES = 2  # Segundos entre envíos de solicitudes
+ESPERA_INICIAL = 5  # Segundos antes de la primera re-verificación
+ESPERA_MAXIMA = 60  # Tope del backoff exponencial
+TIEMPO_MAXIMO_MONITOREO = 30 * 60  # 30 minutos máximo
+DURACION_TOKEN_SAT = 300  # Segundos de validez de un token del SAT
+VIGENCIA_TOKEN = 240  # Segundos que se reutiliza un token guardado
+MARGEN_TOKEN = 30  # Vida mínima del token antes de cada llamada al SAT
 
 # Colores para terminal
 class Colors:
@@ -46,58 +93,121 @@ class Colors:
     END = '\033[0m'
     BOLD = '\033[1m'
 
+# Sin ANSI si la salida no es una terminal o si el usuario define NO_COLOR
+if not sys.stdout.isatty() or os.environ.get('NO_COLOR'):
+    Colors.HEADER = Colors.BLUE = Colors.CYAN = Colors.GREEN = ''
+    Colors.YELLOW = Colors.RED = Colors.END = Colors.BOLD = ''
+
+@functools.lru_cache(maxsize=1024)
 def color(text: str, c: str) -> str:
     """Aplica color al texto."""
     return f"{c}{text}{Colors.END}"
 
+# Separadores precalculados
+_SEP_CYAN = color("=" * 70, Colors.CYAN)
+_SEP_BLUE = color("-" * 50, Colors.BLUE)
+
 def print_header():
     """Imprime el header del programa."""
     print()
-    print(color("=" * 70, Colors.CYAN))
+    print(_SEP_CYAN)
     print(color("  🇲🇽 SAT DESCARGA DEMO - Conexión Real al SAT", Colors.BOLD))
     print(color("  Sistema de Recuperación de IVA", Colors.CYAN))
-    print(color("=" * 70, Colors.CYAN))
+    print(_SEP_CYAN)
     print()
 
 def print_step(step: int, total: int, message: str):
     """Imprime un paso del proceso."""
     print(f"\n{color(f'[{step}/{total}]', Colors.BLUE)} {color(message, Colors.BOLD)}")
-    print(color("-" * 50, Colors.BLUE))
+    print(_SEP_BLUE)
+
+def fmt_success(message: str) -> str:
+    """Formatea un mensaje de éxito."""
+    return f"  {color('✅', Colors.GREEN)} {message}"
+
+def fmt_error(message: str) -> str:
+    """Formatea un mensaje de error."""
+    return f"  {color('❌', Colors.RED)} {message}"
+
+def fmt_warning(message: str) -> str:
+    """Formatea un mensaje de advertencia."""
+    return f"  {color('⚠️', Colors.YELLOW)} {message}"
+
+def fmt_info(message: str) -> str:
+    """Formatea un mensaje de información."""
+    return f"  {color('ℹ️', Colors.CYAN)} {message}"
+
+def fmt_progress(message: str) -> str:
+    """Formatea un mensaje de progreso."""
+    return f"  {color('⏳', Colors.YELLOW)} {message}"
+
+class _ColorFormatter(logging.Formatter):
+    """Aplica el prefijo emoji+color (fmt_*) indicado en el registro."""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        mensaje = super().format(record)
+        fmt = getattr(record, 'fmt', None)
+        return fmt(mensaje) if fmt else mensaje
+
+# Salida a stdout (mismo stream que print/input para conservar el orden)
+log = logging.getLogger("sat")
+_handler = logging.StreamHandler(sys.stdout)
+_handler.setFormatter(_ColorFormatter())
+log.addHandler(_handler)
+log.setLevel(logging.INFO)
+log.propagate = False
 
 def print_success(message: str):
-    print(f"  {color('✅', Colors.GREEN)} {message}")
+    log.info(message, extra={'fmt': fmt_success})
 
 def print_error(message: str):
-    print(f"  {color('❌', Colors.RED)} {message}")
+    log.error(message, extra={'fmt': fmt_error})
 
 def print_warning(message: str):
-    print(f"  {color('⚠️', Colors.YELLOW)} {message}")
+    log.warning(message, extra={'fmt': fmt_warning})
 
 def print_info(message: str):
-    print(f"  {color('ℹ️', Colors.CYAN)} {message}")
+    log.info(message, extra={'fmt': fmt_info})
 
 def print_progress(message: str):
-    print(f"  {color('⏳', Colors.YELLOW)} {message}")
+    log.info(message, extra={'fmt': fmt_progress})
+
+def print_bloque(lineas: List[str]):
+    """Imprime varias líneas como un solo registro (una escritura)."""
+    log.info('\n'.join(lineas))
 
 # ==============================================================================
 # GESTIÓN DE CONFIGURACIÓN
 # ==============================================================================
 
+def _dumps(obj: Any) -> bytes:
+    """Serializa a JSON (orjson si está disponible)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2).encode('utf-8')
+
+def _loads(data: bytes) -> Any:
+    """Deserializa JSON (orjson si está disponible)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 def load_config() -> Dict:
     """Carga la configuración guardada."""
     if CONFIG_FILE.exists():
         try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return _loads(CONFIG_FILE.read_bytes())
         except:
             pass
     return {}
 
 def save_config(config: Dict):
-    """Guarda la configuración."""
+    """Guarda la configuración (escritura atómica)."""
     try:
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(config, f, indent=4)
+        # Escribir a un temporal y reemplazar: un Ctrl+C no deja el JSON a medias
+        tmp = CONFIG_FILE.with_name(CONFIG_FILE.name + '.tmp')
+        tmp.write_bytes(_dumps(config))
+        os.replace(tmp, CONFIG_FILE)
     except Exception as e:
         print_warning(f"No se pudo guardar config: {e}")
 
@@ -109,6 +219,64 @@ def get_default_dates() -> tuple:
     first_of_last_month = last_month.replace(day=1)
     return first_of_last_month, today
 
+# ==============================================================================
+# PAQUETES
+# ==============================================================================
+
+def guardar_b64(b64_text: str, destino: Path) -> int:
+    """Decodifica base64 por bloques directo a disco. Retorna bytes escritos."""
+    # base64Binary admite saltos de línea: medir sin espacios (sin copiar el texto)
+    espacios = sum(b64_text.count(c) for c in ' \t\r\n')
+    cola = ''.join(b64_text[-16:].split())
+    relleno = 2 if cola.endswith('==') else 1 if cola.endswith('=') else 0
+    esperado = (len(b64_text) - espacios) // 4 * 3 - relleno
+    escritos = 0
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    try:
+        fd = os.open(destino, flags, 0o644)
+        try:
+            # Reservar extents contiguos de una vez (solo POSIX)
+            if hasattr(os, 'posix_fallocate') and esperado > 0:
+                try:
+                    os.posix_fallocate(fd, 0, esperado)
+                except OSError:
+                    pass  # Sistema de archivos sin soporte
+            
+            resto = ''
+            for i in range(0, len(b64_text), CHUNK_B64):
+                bloque = b64_text[i:i + CHUNK_B64]
+                if espacios:
+                    bloque = ''.join(bloque.split())
+                
+                # Decodificar solo múltiplos de 4; el sobrante pasa al siguiente bloque
+                bloque = resto + bloque
+                corte = len(bloque) - len(bloque) % 4
+                bloque, resto = bloque[:corte], bloque[corte:]
+                
+                mv = memoryview(b64decode(bloque))
+                while mv:
+                    n = os.write(fd, mv)
+                    mv = mv[n:]
+                    escritos += n
+            
+            if resto:
+                raise ValueError("Paquete base64 incompleto (longitud no múltiplo de 4)")
+            
+            if escritos != esperado:
+                os.ftruncate(fd, escritos)
+        finally:
+            os.close(fd)
+    except BaseException:
+        # No dejar un ZIP truncado que después se tome como ya descargado
+        destino.unlink(missing_ok=True)
+        raise
+    return escritos
+
+def contar_xmls(zip_path: Path) -> int:
+    """Cuenta los XMLs de un paquete leyendo solo el directorio central."""
+    with zipfile.ZipFile(zip_path) as z:
+        return sum(1 for zi in z.infolist() if zi.filename.endswith('.xml'))
+
 # ==============================================================================
 # INTERFAZ DE USUARIO
 # ==============================================================================
@@ -127,7 +295,14 @@ def input_date(prompt: str, default: datetime) -> datetime:
     while True:
         date_str = input_with_default(prompt, default_str)
         try:
-            return datetime.strptime(date_str, "%Y-%m-%d")
+            # Mismo formato que strptime('%Y-%m-%d'): mes y día sin cero a la izquierda
+            partes = date_str.split('-')
+            if (len(partes) != 3 or not all(p.isdigit() for p in partes)
+                    or len(partes[0]) != 4 or not 1 <= len(partes[1]) <= 2
+                    or not 1 <= len(partes[2]) <= 2):
+                raise ValueError(date_str)
+            y, m, d = partes
+            return datetime(int(y), int(m), int(d))
         except ValueError:
             print_error("Formato inválido. Usa YYYY-MM-DD")
 
@@ -183,8 +358,15 @@ class SATDescargaDemo:
         self.fiel = None
         self.token = None
         self.rfc = ""
+        self._clave_token = b""  # SHA-256 de la FIEL, cifra el token en disco
+        self._token_emitido = 0.0
         self.output_dir = DEFAULT_OUTPUT_DIR
         
+        # Control de ritmo para solicitudes en paralelo
+        self._envio_lock = threading.Lock()
+        self._ultimo_envio = 0.0
+        self._cancelar_envios = threading.Event()
+        
         # Estadísticas
         self.stats = {
             'solicitudes_enviadas': 0,
@@ -207,17 +389,23 @@ class SATDescargaDemo:
         faltantes = []
         
         for nombre, paquete in dependencias.items():
-            try:
-                __import__(nombre)
+            # find_spec localiza el módulo sin ejecutarlo
+            if nombre == 'cfdiclient':
+                instalado = _CFDI_OK
+            else:
+                instalado = find_spec(nombre) is not None
+            
+            if instalado:
                 print_success(f"{nombre} instalado")
-            except ImportError:
+            else:
                 print_error(f"{nombre} NO instalado")
                 faltantes.append(paquete)
         
         if faltantes:
             print()
             print_warning("Instala las dependencias faltantes con:")
-            print(f"    {color(f'pip install {\" \".join(faltantes)}', Colors.YELLOW)}")
+            comando = f"pip install {' '.join(faltantes)}"
+            print(f"    {color(comando, Colors.YELLOW)}")
             return False
         
         return True
@@ -239,16 +427,6 @@ class SATDescargaDemo:
         
         print_info(f"Buscando archivos FIEL para {self.rfc}...")
         
-        # Intentar encontrar automáticamente
-        possible_dirs = [
-            Path(default_fiel_dir),
-            Path.home() / "FIEL",
-            Path.home() / "fiel",
-            Path.home() / self.rfc / "FIEL",
-            Path.home() / "Documents" / "FIEL",
-            Path(f"Z:/Respaldo/Nuevo vol/Otras/{self.rfc[:3]}*/FIEL"),  # Tu estructura
-        ]
-        
         cer_path = None
         key_path = None
         
@@ -259,8 +437,22 @@ class SATDescargaDemo:
             must_exist=True
         )
         
-        # Buscar .cer
-        cer_files = list(fiel_dir.glob("*.cer"))
+        # Buscar .cer y .key en una sola pasada (cada stat cuesta en red)
+        cer_files, key_files = [], []
+        try:
+            with os.scandir(fiel_dir) as it:
+                for entry in it:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    nombre = entry.name.lower()
+                    if nombre.endswith('.cer'):
+                        cer_files.append(Path(entry.path))
+                    elif nombre.endswith('.key'):
+                        key_files.append(Path(entry.path))
+        except OSError:
+            pass
+        
+        # Seleccionar .cer
         if cer_files:
             if len(cer_files) == 1:
                 cer_path = cer_files[0]
@@ -274,8 +466,7 @@ class SATDescargaDemo:
         else:
             cer_path = input_path("Ruta al archivo .cer", "", must_exist=True)
         
-        # Buscar .key
-        key_files = list(fiel_dir.glob("*.key"))
+        # Seleccionar .key
         if key_files:
             if len(key_files) == 1:
                 key_path = key_files[0]
@@ -299,14 +490,15 @@ class SATDescargaDemo:
         print_progress("Cargando FIEL...")
         
         try:
-            from cfdiclient import Fiel
-            
             with open(cer_path, 'rb') as f:
                 cer_data = f.read()
             with open(key_path, 'rb') as f:
                 key_data = f.read()
             
             self.fiel = Fiel(cer_data, key_data, password)
+            self._clave_token = hashlib.sha256(
+                cer_data + key_data + password.encode('utf-8')
+            ).digest()
             print_success("FIEL cargada correctamente")
             
             # Guardar config
@@ -321,21 +513,79 @@ class SATDescargaDemo:
             print_info("Verifica que la contraseña sea correcta")
             return False
     
+    def _fernet(self):
+        """Cifrador del token derivado de la FIEL cargada."""
+        from cryptography.fernet import Fernet
+        
+        return Fernet(base64.urlsafe_b64encode(self._clave_token))
+    
+    def _token_en_cache(self) -> Optional[str]:
+        """Retorna el token guardado si sigue vigente para este RFC y FIEL."""
+        if self.config.get('token_rfc') != self.rfc or not self.config.get('token'):
+            return None
+        
+        edad = time.time() - self.config.get('token_issued_at', 0)
+        if not 0 <= edad < VIGENCIA_TOKEN:
+            return None
+        
+        try:
+            return self._fernet().decrypt(self.config['token'].encode()).decode()
+        except Exception:
+            # Otra FIEL/contraseña o cache corrupto
+            return None
+    
+    def _guardar_token(self):
+        """Guarda el token cifrado en la configuración."""
+        try:
+            self.config['token'] = self._fernet().encrypt(self.token.encode()).decode()
+        except Exception as e:
+            print_warning(f"No se pudo cifrar el token: {e}")
+            return
+        self.config['token_issued_at'] = self._token_emitido
+        self.config['token_rfc'] = self.rfc
+        save_config(self.config)
+    
+    def _vida_restante_token(self) -> float:
+        """Segundos que le quedan al token actual según el SAT."""
+        return DURACION_TOKEN_SAT - (time.time() - self._token_emitido)
+    
+    def _asegurar_token(self, margen: float = MARGEN_TOKEN):
+        """Renueva el token si le quedan menos de `margen` segundos."""
+        restante = self._vida_restante_token()
+        if restante >= margen:
+            return
+        print_info(f"El token vence en {max(restante, 0):.0f} s; renovando...")
+        if not self._solicitar_token():
+            print_warning("Se continúa con el token actual")
+    
     def autenticar(self) -> bool:
         """Obtiene token de autenticación del SAT."""
         print_step(3, 6, "Autenticación con el SAT")
         
+        token = self._token_en_cache()
+        if token:
+            self.token = token
+            self._token_emitido = self.config['token_issued_at']
+            print_success("Token reutilizado (aún vigente)")
+            print_info(f"Token: {self.token[:50]}...")
+            return True
+        
+        return self._solicitar_token()
+    
+    def _solicitar_token(self) -> bool:
+        """Pide un token nuevo al SAT y lo guarda en el cache."""
         print_progress("Conectando al servicio de autenticación...")
         
         try:
-            from cfdiclient import Autenticacion
-            
             auth = Autenticacion(self.fiel)
-            self.token = auth.obtener_token()
+            token = auth.obtener_token()
             
-            if self.token:
+            if token:
+                self.token = token
+                self._token_emitido = time.time()
                 print_success("¡Autenticación exitosa!")
                 print_info(f"Token: {self.token[:50]}...")
+                self._guardar_token()
                 return True
             else:
                 print_error("No se obtuvo token")
@@ -403,6 +653,21 @@ class SATDescargaDemo:
     
     def dividir_periodos(self, inicio: datetime, fin: datetime, dias: int = 7) -> List[tuple]:
         """Divide un rango de fechas en sub-rangos."""
+        try:
+            # Import diferido: numpy solo se carga si se dividen períodos
+            import numpy as np
+        except ImportError:
+            np = None
+        
+        if np is not None:
+            # Límites de todos los sub-rangos en una sola operación vectorizada;
+            # resolución de microsegundos para conservar la hora igual que el bucle
+            ini = np.datetime64(inicio, 'us')
+            end = np.datetime64(fin, 'us')
+            inicios = np.arange(ini, end + np.timedelta64(1, 'us'), np.timedelta64(dias, 'D'))
+            finales = np.minimum(inicios + np.timedelta64(dias - 1, 'D'), end)
+            return list(zip(inicios.tolist(), finales.tolist()))
+        
         rangos = []
         actual = inicio
         
@@ -413,17 +678,45 @@ class SATDescargaDemo:
         
         return rangos
     
+    def _enviar_solicitud(self, inicio: datetime, fin: datetime, config: Dict) -> Dict:
+        """Envía una solicitud al SAT respetando la pausa entre envíos."""
+        with self._envio_lock:
+            espera = self._ultimo_envio + PAUSA_SOLICITUDES - time.monotonic()
+            if espera > 0:
+                self._cancelar_envios.wait(espera)
+            if self._cancelar_envios.is_set():
+                raise RuntimeError("Envío cancelado por usuario")
+            self._ultimo_envio = time.monotonic()
+        
+        # Seleccionar servicio (una instancia por llamada: no son thread-safe)
+        if config['tipo_cfdi'] == 'ISSUED':
+            service = SolicitaDescargaEmitidos(self.fiel)
+            kwargs = {'rfc_emisor': self.rfc}
+        else:
+            service = SolicitaDescargaRecibidos(self.fiel)
+            kwargs = {'rfc_receptor': self.rfc}
+        
+        return service.solicitar_descarga(
+            self.token,
+            self.rfc,
+            inicio,
+            fin,
+            tipo_solicitud=config['tipo_descarga'],
+            **kwargs
+        )
+    
+    def _verificar_solicitud(self, sol: Dict) -> tuple:
+        """Consulta el estado de una solicitud. Retorna (sol, response, error)."""
+        try:
+            verifier = VerificaSolicitudDescarga(self.fiel)
+            return sol, verifier.verificar_descarga(self.token, self.rfc, sol['id']), None
+        except Exception as e:
+            return sol, None, e
+    
     def ejecutar_descarga(self, config: Dict) -> bool:
         """Ejecuta el proceso de descarga."""
         print_step(5, 6, "Ejecutando descarga")
         
-        from cfdiclient import (
-            SolicitaDescargaEmitidos,
-            SolicitaDescargaRecibidos,
-            VerificaSolicitudDescarga,
-            DescargaMasiva
-        )
-        
         # Dividir en períodos
         rangos = self.dividir_periodos(
             config['fecha_inicio'],
@@ -432,174 +725,328 @@ class SATDescargaDemo:
         
         print_info(f"Se generarán {len(rangos)} solicitud(es)")
         
+        # El token debe durar todos los envíos (uno cada PAUSA_SOLICITUDES);
+        # ni uno recién emitido rebasa VIGENCIA_TOKEN
+        self._asegurar_token(min(len(rangos) * PAUSA_SOLICITUDES + MARGEN_TOKEN, VIGENCIA_TOKEN))
+        
         solicitudes = []
+        self._cancelar_envios.clear()
         
-        # Enviar solicitudes
-        for i, (inicio, fin) in enumerate(rangos, 1):
-            print(f"\n  📤 Solicitud {i}/{len(rangos)}: {inicio.date()} → {fin.date()}")
+        # Enviar solicitudes en paralelo
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            futuros = {
+                pool.submit(self._enviar_solicitud, inicio, fin, config): (inicio, fin)
+                for inicio, fin in rangos
+            }
             
             try:
-                # Seleccionar servicio
-                if config['tipo_cfdi'] == 'ISSUED':
-                    service = SolicitaDescargaEmitidos(self.fiel)
-                    kwargs = {'rfc_emisor': self.rfc}
-                else:
-                    service = SolicitaDescargaRecibidos(self.fiel)
-                    kwargs = {'rfc_receptor': self.rfc}
-                
-                # Enviar solicitud
-                response = service.solicitar_descarga(
-                    self.token,
-                    self.rfc,
-                    inicio,
-                    fin,
-                    tipo_solicitud=config['tipo_descarga'],
-                    **kwargs
-                )
-                
-                cod = response.get('cod_estatus', 'N/A')
-                msg = response.get('mensaje', '')
-                rid = response.get('id_solicitud')
-                
-                if rid:
-                    print_success(f"ID: {rid}")
-                    solicitudes.append({
-                        'id': rid,
-                        'inicio': inicio,
-                        'fin': fin,
-                        'status': 1
-                    })
-                    self.stats['solicitudes_enviadas'] += 1
-                else:
-                    print_error(f"Sin ID - cod={cod} msg={msg}")
-                    self.stats['errores'] += 1
-                
-                # Esperar entre solicitudes
-                if i < len(rangos):
-                    time.sleep(2)
+                for i, futuro in enumerate(as_completed(futuros), 1):
+                    inicio, fin = futuros[futuro]
+                    buf = [f"\n  📤 Solicitud {i}/{len(rangos)}: {inicio.date()} → {fin.date()}"]
+                    
+                    try:
+                        response = futuro.result()
+                        
+                        cod = response.get('cod_estatus', 'N/A')
+                        msg = response.get('mensaje', '')
+                        rid = response.get('id_solicitud')
+                        
+                        if rid:
+                            buf.append(fmt_success(f"ID: {rid}"))
+                            solicitudes.append({
+                                'id': rid,
+                                'inicio': inicio,
+                                'fin': fin,
+                                'status': 1
+                            })
+                            self.stats['solicitudes_enviadas'] += 1
+                        else:
+                            buf.append(fmt_error(f"Sin ID - cod={cod} msg={msg}"))
+                            self.stats['errores'] += 1
+                            
+                    except Exception as e:
+                        buf.append(fmt_error(f"Error: {e}"))
+                        self.stats['errores'] += 1
                     
-            except Exception as e:
-                print_error(f"Error: {e}")
-                self.stats['errores'] += 1
+                    print_bloque(buf)
+            except BaseException:
+                # Ctrl+C: no enviar al SAT las solicitudes que siguen en cola
+                self._cancelar_envios.set()
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
         
         if not solicitudes:
             print_error("No se generaron solicitudes válidas")
             return False
         
+        solicitudes.sort(key=lambda s: s['inicio'])
+        
         # Monitorear y descargar
         print(f"\n  ⏳ Monitoreando {len(solicitudes)} solicitud(es)...")
         
-        verifier = VerificaSolicitudDescarga(self.fiel)
-        downloader = DescargaMasiva(self.fiel)
+        pendientes = deque(solicitudes)
+        espera = ESPERA_INICIAL
+        limite = time.monotonic() + TIEMPO_MAXIMO_MONITOREO
         
-        pendientes = list(solicitudes)
-        intentos = 0
-        max_intentos = 30  # 30 minutos máximo
-        
-        while pendientes and intentos < max_intentos:
-            intentos += 1
-            nuevos_pendientes = []
-            
-            for sol in pendientes:
-                try:
-                    print(f"\n  🔍 Verificando {sol['id'][:12]}...")
+        with ThreadPoolExecutor(max_workers=MAX_VERIFICACIONES) as verificador:
+            while pendientes and time.monotonic() < limite:
+                self._asegurar_token()
+                hubo_cambio = False
+                listas = []
+                
+                # Verificar todo el lote a la vez; los sobrevivientes regresan a la cola
+                lote = list(pendientes)
+                pendientes.clear()
+                
+                for sol, response, error in verificador.map(self._verificar_solicitud, lote):
+                    buf = [f"\n  🔍 Verificando {sol['id'][:12]}..."]
                     
-                    response = verifier.verificar_descarga(
-                        self.token,
-                        self.rfc,
-                        sol['id']
-                    )
+                    if error is not None:
+                        buf.append(fmt_error(f"Error verificando: {error}"))
+                        pendientes.append(sol)
+                        print_bloque(buf)
+                        continue
                     
                     estado = int(response.get('estado_solicitud', -1))
                     msg = response.get('mensaje', '')
                     
+                    if estado != sol['status']:
+                        hubo_cambio = True
+                        sol['status'] = estado
+                    
                     if estado == 1:
-                        print_info(f"Estado: Aceptada - {msg}")
-                        nuevos_pendientes.append(sol)
+                        buf.append(fmt_info(f"Estado: Aceptada - {msg}"))
+                        pendientes.append(sol)
                         
                     elif estado == 2:
-                        print_info(f"Estado: En proceso - {msg}")
-                        nuevos_pendientes.append(sol)
+                        buf.append(fmt_info(f"Estado: En proceso - {msg}"))
+                        pendientes.append(sol)
                         
                     elif estado == 3:
-                        print_success(f"Estado: ¡Lista para descarga!")
+                        buf.append(fmt_success(f"Estado: ¡Lista para descarga!"))
                         paquetes = response.get('paquetes') or []
                         
                         if paquetes:
-                            print_info(f"Paquetes disponibles: {len(paquetes)}")
-                            self.descargar_paquetes(downloader, paquetes)
+                            buf.append(fmt_info(f"Paquetes disponibles: {len(paquetes)}"))
+                            listas.append((sol, paquetes))
                         else:
-                            print_warning("Sin paquetes (período sin CFDIs)")
+                            buf.append(fmt_warning("Sin paquetes (período sin CFDIs)"))
                             
                     elif estado in (4, 5):
-                        print_error(f"Estado: Error/Rechazada - {msg}")
+                        buf.append(fmt_error(f"Estado: Error/Rechazada - {msg}"))
                         self.stats['errores'] += 1
                         
                     else:
-                        print_warning(f"Estado desconocido: {estado}")
-                        nuevos_pendientes.append(sol)
-                        
-                except Exception as e:
-                    print_error(f"Error verificando: {e}")
-                    nuevos_pendientes.append(sol)
-            
-            pendientes = nuevos_pendientes
-            
-            if pendientes:
-                print(f"\n  ⏰ Esperando 60 segundos... ({len(pendientes)} pendiente(s))")
-                print("     (Ctrl+C para cancelar)")
-                try:
-                    time.sleep(60)
-                except KeyboardInterrupt:
-                    print_warning("\nCancelado por usuario")
-                    break
+                        buf.append(fmt_warning(f"Estado desconocido: {estado}"))
+                        pendientes.append(sol)
+                    
+                    print_bloque(buf)
+                
+                # Descargas fuera del pool de verificación
+                for sol, paquetes in listas:
+                    print(f"\n  📥 Paquetes de {sol['id'][:12]}...")
+                    self._asegurar_token()
+                    try:
+                        self.descargar_paquetes(paquetes)
+                    except Exception as e:
+                        print_error(f"Error descargando: {e}")
+                        pendientes.append(sol)
+                
+                if pendientes:
+                    # Backoff exponencial con jitter; se reinicia si el SAT avanzó
+                    if hubo_cambio:
+                        espera = ESPERA_INICIAL
+                    pausa = espera * random.uniform(0.8, 1.2)
+                    espera = min(espera * 2, ESPERA_MAXIMA)
+                    
+                    print(f"\n  ⏰ Esperando {pausa:.0f} segundos... ({len(pendientes)} pendiente(s))")
+                    print("     (Ctrl+C para cancelar)")
+                    try:
+                        time.sleep(pausa)
+                    except KeyboardInterrupt:
+                        print_warning("\nCancelado por usuario")
+                        break
         
         return True
     
-    def descargar_paquetes(self, downloader, paquetes: List[str]):
-        """Descarga los paquetes de CFDIs."""
-        for i, pkg_id in enumerate(paquetes, 1):
+    def _guardar_paquete(self, response: Dict, zip_path: Path) -> Dict:
+        """Guarda en disco la respuesta de descarga de un paquete."""
+        resultado = {
+            'cod_estatus': response.get('cod_estatus', 'N/A'),
+            'mensaje': response.get('mensaje', ''),
+            'bytes': None,
+            'n_xml': None
+        }
+        if response.get('paquete_b64'):
+            resultado['bytes'] = guardar_b64(response['paquete_b64'], zip_path)
+            
+            # Contar aquí, en el hilo de la descarga: se solapa con las demás
             try:
-                print(f"\n    📦 Descargando paquete {i}/{len(paquetes)}...")
-                
-                zip_path = self.output_dir / f"{pkg_id}.zip"
-                
-                if zip_path.exists():
-                    print_warning(f"Ya existe: {zip_path.name}")
-                    self.stats['paquetes_descargados'] += 1
-                    continue
-                
-                response = downloader.descargar_paquete(
-                    self.token,
-                    self.rfc,
-                    pkg_id
-                )
-                
-                if response.get('paquete_b64'):
-                    data = base64.b64decode(response['paquete_b64'])
-                    size_kb = len(data) / 1024
-                    
-                    with open(zip_path, 'wb') as f:
-                        f.write(data)
-                    
-                    print_success(f"Guardado: {zip_path.name} ({size_kb:.1f} KB)")
-                    self.stats['paquetes_descargados'] += 1
-                    
-                    # Contar XMLs
+                resultado['n_xml'] = contar_xmls(zip_path)
+            except Exception:
+                pass
+        return resultado
+    
+    def _descargar_paquete(self, pkg_id: str, zip_path: Path) -> Dict:
+        """Descarga un paquete y lo guarda en disco."""
+        response = DescargaMasiva(self.fiel).descargar_paquete(
+            self.token,
+            self.rfc,
+            pkg_id
+        )
+        return self._guardar_paquete(response, zip_path)
+    
+    @staticmethod
+    def _leer_respuesta_paquete(servicio, status: int, contenido: bytes) -> Dict:
+        """Interpreta la respuesta SOAP de descarga igual que cfdiclient."""
+        if status != 200:
+            # Puede no ser XML (p.ej. una página HTML de un 503)
+            try:
+                root = etree.fromstring(contenido, parser=etree.XMLParser(huge_tree=True))
+                error = servicio.get_element_external(root, servicio.fault_xpath)
+            except etree.XMLSyntaxError:
+                error = None
+            if error is not None and error.text:
+                raise Exception(f"HTTP {status}: {error.text}")
+            raise Exception(f"HTTP {status}")
+        
+        root = etree.fromstring(contenido, parser=etree.XMLParser(huge_tree=True))
+        paquete = servicio.get_element_external(root, servicio.result_xpath)
+        respuesta = servicio.get_element_external(root, 's:Header/h:respuesta')
+        return {
+            'cod_estatus': respuesta.get('CodEstatus') if respuesta is not None else None,
+            'mensaje': respuesta.get('Mensaje') if respuesta is not None else None,
+            'paquete_b64': paquete.text if paquete is not None else None,
+        }
+    
+    async def _descargar_async(self, sess, pkg_id: str, zip_path: Path) -> Dict:
+        """Descarga un paquete vía aiohttp usando el sobre SOAP de cfdiclient."""
+        # Mismo sobre firmado que arma DescargaMasiva.descargar_paquete
+        servicio = DescargaMasiva(self.fiel)
+        solicitud = servicio.set_request_arguments({
+            'RfcSolicitante': self.rfc.upper(),
+            'IdPaquete': pkg_id,
+        })
+        servicio.signer.sign(solicitud)
+        
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=servicio.timeout,
+            sock_read=servicio.timeout
+        )
+        async with sess.post(
+            servicio.soap_url,
+            data=servicio.element_to_bytes(servicio.element_root),
+            headers=servicio.get_headers(self.token),
+            timeout=timeout
+        ) as resp:
+            # El cuerpo SOAP y el árbol lxml viven solo dentro del helper: durante
+            # la decodificación únicamente queda vivo el texto base64
+            response = self._leer_respuesta_paquete(servicio, resp.status, await resp.read())
+        
+        # Decodificar/escribir fuera del event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._guardar_paquete, response, zip_path)
+    
+    async def _descargar_uno_async(self, sess, pkg_id: str, zip_path: Path) -> tuple:
+        """Descarga un paquete; devuelve (pkg_id, zip_path, resultado, error)."""
+        try:
+            return pkg_id, zip_path, await self._descargar_async(sess, pkg_id, zip_path), None
+        except Exception as e:
+            return pkg_id, zip_path, None, e
+    
+    async def _descargar_todos_async(self, trabajos: List[tuple], al_terminar):
+        """Descarga todos los paquetes concurrentemente, reportando cada uno al terminar."""
+        conector = aiohttp.TCPConnector(limit=MAX_WORKERS)
+        async with aiohttp.ClientSession(connector=conector) as sess:
+            tareas = [
+                asyncio.ensure_future(self._descargar_uno_async(sess, pkg_id, zip_path))
+                for pkg_id, zip_path in trabajos
+            ]
+            for siguiente in asyncio.as_completed(tareas):
+                al_terminar(*await siguiente)
+    
+    def _descargar_en_paralelo(self, trabajos: List[tuple], al_terminar):
+        """Descarga (pkg_id, zip_path) en paralelo; llama al_terminar(pkg_id, zip_path, resultado, error)."""
+        if aiohttp is not None:
+            # asyncio.run cancela las tareas pendientes ante Ctrl+C
+            asyncio.run(self._descargar_todos_async(trabajos, al_terminar))
+            return
+        
+        # Sin aiohttp: hilos sobre la API síncrona de cfdiclient
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            futuros = {
+                pool.submit(self._descargar_paquete, pkg_id, zip_path): (pkg_id, zip_path)
+                for pkg_id, zip_path in trabajos
+            }
+            try:
+                for futuro in as_completed(futuros):
+                    pkg_id, zip_path = futuros[futuro]
                     try:
-                        with zipfile.ZipFile(io.BytesIO(data)) as z:
-                            xmls = [f for f in z.namelist() if f.endswith('.xml')]
-                            self.stats['xmls_extraidos'] += len(xmls)
-                            print_info(f"Contenido: {len(xmls)} XMLs")
-                    except:
-                        pass
-                else:
-                    cod = response.get('cod_estatus', 'N/A')
-                    msg = response.get('mensaje', '')
-                    print_error(f"Sin datos - cod={cod} msg={msg}")
-                    
-            except Exception as e:
-                print_error(f"Error descargando: {e}")
+                        resultado = futuro.result()
+                    except Exception as e:
+                        al_terminar(pkg_id, zip_path, None, e)
+                    else:
+                        al_terminar(pkg_id, zip_path, resultado, None)
+            except BaseException:
+                # Ctrl+C: descartar descargas en cola
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+    
+    def descargar_paquetes(self, paquetes: List[str]):
+        """Descarga los paquetes de CFDIs."""
+        conteos = self.config.setdefault('package_xml_counts', {})
+        nuevos_conteos = False
+        trabajos = []
+        
+        for pkg_id in paquetes:
+            zip_path = self.output_dir / f"{pkg_id}.zip"
+            
+            if zip_path.exists():
+                print_warning(f"Ya existe: {zip_path.name}")
+                self.stats['paquetes_descargados'] += 1
+                if pkg_id not in conteos:
+                    # Paquete de una corrida anterior sin conteo guardado
+                    try:
+                        conteos[pkg_id] = contar_xmls(zip_path)
+                        nuevos_conteos = True
+                    except Exception:
+                        continue
+                self.stats['xmls_extraidos'] += conteos[pkg_id]
+                continue
+            
+            trabajos.append((pkg_id, zip_path))
+        
+        hechos = 0
+        
+        def registrar(pkg_id, zip_path, resultado, error):
+            nonlocal hechos, nuevos_conteos
+            hechos += 1
+            print(f"\n    📦 Paquete {hechos}/{len(trabajos)}...")
+            
+            if error is not None:
+                print_error(f"Error descargando: {error}")
+                return
+            
+            if resultado['bytes'] is not None:
+                size_kb = resultado['bytes'] / 1024
+                print_success(f"Guardado: {zip_path.name} ({size_kb:.1f} KB)")
+                self.stats['paquetes_descargados'] += 1
+                
+                n_xml = resultado['n_xml']
+                if n_xml is not None:
+                    conteos[pkg_id] = n_xml
+                    nuevos_conteos = True
+                    self.stats['xmls_extraidos'] += n_xml
+                    print_info(f"Contenido: {n_xml} XMLs")
+            else:
+                cod = resultado['cod_estatus']
+                msg = resultado['mensaje']
+                print_error(f"Sin datos - cod={cod} msg={msg}")
+        
+        self._descargar_en_paralelo(trabajos, registrar)
+        
+        if nuevos_conteos:
+            save_config(self.config)
     
     def mostrar_resumen(self):
         """Muestra el resumen final."""